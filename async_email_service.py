@@ -0,0 +1,483 @@
+import asyncio
+import socket
+from contextlib import asynccontextmanager
+from typing import List, Optional
+import logging
+
+import aiosmtplib
+import httpx
+import orjson
+from email.message import EmailMessage
+from email.utils import formataddr
+
+from email_service import SMTP_POLICY, EmailService, build_message, collect_recipients, handle_sendgrid_response
+
+# Cliente HTTP/2 compartido hacia SendGrid: multiplexa todas las llamadas
+# sobre una misma conexión persistente. Se crea perezosamente y se cierra
+# desde el shutdown hook de la aplicación.
+_sg_client: Optional[httpx.AsyncClient] = None
+
+def _get_sg_client() -> httpx.AsyncClient:
+    global _sg_client
+    if _sg_client is None:
+        _sg_client = httpx.AsyncClient(
+            http2=True,
+            timeout=10.0,
+            limits=httpx.Limits(max_keepalive_connections=20)
+        )
+    return _sg_client
+
+async def close_sg_client():
+    global _sg_client
+    if _sg_client is not None:
+        await _sg_client.aclose()
+        _sg_client = None
+
+class AsyncEmailService:
+    """Versión asíncrona de EmailService basada en aiosmtplib.
+
+    A diferencia de la versión síncrona, el I/O de red (handshake TLS,
+    comandos SMTP) no bloquea el event loop de FastAPI, así que el worker
+    puede atender otras peticiones mientras los round-trips están en vuelo.
+    Mantiene un pool de conexiones pre-autenticadas; el tamaño del pool es
+    el tope de envíos concurrentes (cada conexión SMTP envía de a uno).
+    """
+
+    def __init__(
+        self,
+        smtp_server: str,
+        smtp_port: int,
+        username: str,
+        password: str,
+        sender_email: str,
+        sender_name: str,
+        sendgrid_api_key: str = None,
+        pool_size: int = 2
+    ):
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.username = username
+        self.password = password
+        self.sender_email = sender_email
+        self.sender_name = sender_name
+        self.sendgrid_api_key = sendgrid_api_key
+
+        # Header From formateado una sola vez (RFC 2047 si hace falta)
+        self._from_header = formataddr((sender_name, sender_email))
+
+        self.logger = logging.getLogger(__name__)
+
+        # Pools de conexiones reutilizables, uno por destino: la clave
+        # (servidor, puerto, ssl, usuario) evita mezclar sesiones de cuentas
+        # o servidores distintos. Los None son marcadores: la conexión real
+        # se abre recién cuando alguien la necesita.
+        self.pool_size = pool_size
+        self._pools: dict = {}
+
+    def _get_pool(self, key: tuple) -> asyncio.Queue:
+        """Obtener (o crear) el pool de conexiones para un destino"""
+        pool = self._pools.get(key)
+        if pool is None:
+            pool = asyncio.Queue(maxsize=self.pool_size)
+            for _ in range(self.pool_size):
+                pool.put_nowait(None)
+            self._pools[key] = pool
+        return pool
+
+    async def _connect(self, smtp_server: str, smtp_port: int, use_ssl: bool) -> aiosmtplib.SMTP:
+        """Abrir y autenticar una conexión nueva"""
+        smtp = aiosmtplib.SMTP(
+            hostname=smtp_server,
+            port=smtp_port,
+            use_tls=use_ssl,
+            start_tls=not use_ssl
+        )
+        await smtp.connect()
+        await smtp.login(self.username, self.password)
+        return smtp
+
+    @asynccontextmanager
+    async def _acquire(self, smtp_server: Optional[str] = None, smtp_port: Optional[int] = None, use_ssl: Optional[bool] = None):
+        """Tomar una conexión del pool del destino, reconectando si murió.
+
+        Sin argumentos usa el servidor principal configurado.
+        """
+        if smtp_server is None:
+            smtp_server = self.smtp_server
+        if smtp_port is None:
+            smtp_port = self.smtp_port
+        if use_ssl is None:
+            use_ssl = smtp_port == 465
+
+        pool = self._get_pool((smtp_server, smtp_port, use_ssl, self.username))
+        smtp = await pool.get()
+        try:
+            if smtp is None or not smtp.is_connected:
+                smtp = await self._connect(smtp_server, smtp_port, use_ssl)
+            else:
+                try:
+                    # Validar la conexión cacheada antes de reusarla
+                    await smtp.noop()
+                except aiosmtplib.SMTPException:
+                    # Cerrar el socket muerto antes de reemplazarlo
+                    smtp.close()
+                    smtp = await self._connect(smtp_server, smtp_port, use_ssl)
+            yield smtp
+        except BaseException:
+            # Conexión en estado desconocido: cerrarla y devolver el marcador
+            # vacío. BaseException y no Exception: la carrera de fallbacks
+            # cancela tareas en pleno sendmail, y CancelledError no hereda de
+            # Exception — devolver esa conexión viva al pool dejaría una
+            # sesión a mitad de transacción que hasta puede pasar el noop()
+            if smtp is not None:
+                try:
+                    smtp.close()
+                except Exception:
+                    pass
+            smtp = None
+            raise
+        finally:
+            pool.put_nowait(smtp)
+
+    async def test_connectivity(self) -> dict:
+        """Probar conectividad a los servidores SMTP sin bloquear el event loop.
+
+        Las pruebas son independientes, así que corren todas juntas con
+        gather: el total tarda lo que el host más lento.
+        """
+        targets = [(self.smtp_server, self.smtp_port)]
+        for config in EmailService.fallback_configs:
+            if (config['server'], config['port']) not in targets:
+                targets.append((config['server'], config['port']))
+
+        probes = await asyncio.gather(
+            *(self._test_smtp_connection(server, port) for server, port in targets),
+            return_exceptions=True
+        )
+
+        results = {}
+        for (server, port), probe in zip(targets, probes):
+            if isinstance(probe, Exception):
+                probe = {"status": "error", "message": f"Error: {str(probe)}"}
+            results[f"{server}:{port}"] = probe
+        return results
+
+    async def _test_smtp_connection(self, server: str, port: int, timeout: int = 10) -> dict:
+        """Probar conexión TCP a un servidor SMTP específico"""
+        try:
+            self.logger.info("Probando conexión a %s:%s", server, port)
+            _, writer = await asyncio.wait_for(
+                asyncio.open_connection(server, port), timeout=timeout
+            )
+            writer.close()
+            await writer.wait_closed()
+            return {"status": "reachable", "message": "Conexión exitosa"}
+        except asyncio.TimeoutError:
+            return {"status": "unreachable", "message": f"Timeout tras {timeout}s"}
+        except socket.gaierror as e:
+            return {"status": "dns_error", "message": f"Error DNS: {str(e)}"}
+        except OSError as e:
+            return {"status": "unreachable", "message": f"Error de conexión: {str(e)}"}
+
+    async def send_email(
+        self,
+        to_emails: List[str],
+        subject: str,
+        body: str,
+        cc_emails: Optional[List[str]] = None,
+        bcc_emails: Optional[List[str]] = None,
+        attachments: Optional[List[str]] = None,
+        is_html: bool = False,
+        use_fallback: bool = True
+    ) -> dict:
+        """Enviar email de forma asíncrona usando una conexión del pool.
+
+        Si el servidor principal falla y use_fallback está activo, las
+        alternativas se corren TODAS en paralelo y gana la primera que
+        responda con éxito: la latencia es la del servidor más rápido, no
+        la suma de los timeouts de los caídos.
+        """
+        # Mismo camino de construcción que el servicio síncrono; solo el
+        # transporte cambia. El mensaje se serializa una única vez a bytes.
+        # Con adjuntos, la preparación hace stat/open/mmap y codifica base64
+        # (syscalls y CPU que bloquearían el loop): se despacha a un thread.
+        def prepare() -> bytes:
+            msg = build_message(
+                self._from_header,
+                to_emails, subject, body, cc_emails, attachments, is_html
+            )
+            return msg.as_bytes(policy=SMTP_POLICY)
+
+        raw = await asyncio.to_thread(prepare) if attachments else prepare()
+        all_recipients = collect_recipients(to_emails, cc_emails, bcc_emails)
+
+        result = await self._attempt_send(
+            self.smtp_server, self.smtp_port, self.smtp_port == 465, all_recipients, raw
+        )
+
+        if result["status"] == "success" or not use_fallback:
+            return result
+
+        # Solo escalar a los fallbacks ante problemas de conexión/red;
+        # un error de autenticación se repetiría igual en todos lados
+        if result["status"] not in ("connection_error", "error"):
+            return result
+
+        self.logger.warning("Fallo principal: %s. Corriendo configuraciones alternativas en paralelo...", result['message'])
+
+        tasks = {}
+        for config in EmailService.fallback_configs:
+            if config['server'] == self.smtp_server and config['port'] == self.smtp_port:
+                continue  # Ya falló como configuración principal
+            task = asyncio.create_task(self._attempt_send(
+                config['server'], config['port'], config['ssl'], all_recipients, raw
+            ))
+            tasks[task] = f"{config['server']}:{config['port']}"
+
+        pending = set(tasks)
+        last_result = result
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                fallback_result = task.result()
+                if fallback_result["status"] == "success":
+                    for still_pending in pending:
+                        still_pending.cancel()
+                    fallback_result["fallback_used"] = tasks[task]
+                    return fallback_result
+                last_result = fallback_result
+
+        return last_result
+
+    async def _attempt_send(
+        self,
+        smtp_server: str,
+        smtp_port: int,
+        use_ssl: bool,
+        all_recipients: List[str],
+        raw: bytes
+    ) -> dict:
+        """Intentar enviar un mensaje ya serializado contra un servidor"""
+        try:
+            async with self._acquire(smtp_server, smtp_port, use_ssl) as smtp:
+                await smtp.sendmail(self.sender_email, all_recipients, raw)
+
+            self.logger.info("Email enviado exitosamente via %s:%s a %s destinatarios", smtp_server, smtp_port, len(all_recipients))
+
+            return {
+                "status": "success",
+                "message": f"Email enviado exitosamente a {len(all_recipients)} destinatarios",
+                "recipients": len(all_recipients),
+                "server_used": f"{smtp_server}:{smtp_port}"
+            }
+
+        except aiosmtplib.SMTPAuthenticationError as e:
+            error_msg = f"Error de autenticación SMTP: {str(e)}"
+            self.logger.error(error_msg)
+            return {"status": "auth_error", "message": error_msg}
+
+        except aiosmtplib.SMTPConnectError as e:
+            error_msg = f"Error de conexión SMTP a {smtp_server}:{smtp_port}: {str(e)}"
+            self.logger.error(error_msg)
+            return {"status": "connection_error", "message": error_msg}
+
+        except Exception as e:
+            error_msg = f"Error inesperado enviando email via {smtp_server}:{smtp_port}: {str(e)}"
+            self.logger.error(error_msg)
+            return {"status": "error", "message": error_msg}
+
+    async def send_bulk(self, messages: List[dict]) -> dict:
+        """Enviar N mensajes distintos sobre UNA sola sesión autenticada.
+
+        Cada mensaje es un dict con las claves de send_email (to_emails,
+        subject, body, cc_emails, bcc_emails, is_html). El handshake
+        TCP+TLS+AUTH se paga una vez para todo el lote; un fallo en un
+        mensaje se limpia con RSET sin tirar el socket.
+        """
+        results = []
+        sent = 0
+
+        try:
+            async with self._acquire() as smtp:
+                for message in messages:
+                    to_emails = message["to_emails"]
+                    msg = build_message(
+                        self._from_header,
+                        to_emails, message["subject"], message["body"],
+                        message.get("cc_emails"), None, message.get("is_html", False)
+                    )
+                    raw = msg.as_bytes(policy=SMTP_POLICY)
+                    all_recipients = collect_recipients(
+                        to_emails, message.get("cc_emails"), message.get("bcc_emails")
+                    )
+
+                    try:
+                        await smtp.sendmail(self.sender_email, all_recipients, raw)
+                        sent += 1
+                        results.append({"status": "success", "recipients": len(all_recipients)})
+                    except aiosmtplib.SMTPServerDisconnected:
+                        # Sin conexión no tiene sentido seguir con el lote
+                        results.append({"status": "error", "message": "Conexión perdida durante el lote"})
+                        raise
+                    except aiosmtplib.SMTPException as e:
+                        # Fallo de este mensaje: resetear la sesión y seguir
+                        results.append({"status": "error", "message": str(e)})
+                        await smtp.rset()
+        except aiosmtplib.SMTPException as e:
+            error_msg = f"Error enviando lote via {self.smtp_server}:{self.smtp_port}: {str(e)}"
+            self.logger.error(error_msg)
+            # Los mensajes que no llegaron a intentarse quedan marcados
+            for _ in range(len(messages) - len(results)):
+                results.append({"status": "error", "message": error_msg})
+
+        status = "success" if sent == len(messages) else ("partial" if sent else "error")
+        self.logger.info("Lote enviado: %s/%s mensajes via %s:%s", sent, len(messages), self.smtp_server, self.smtp_port)
+
+        return {
+            "status": status,
+            "message": f"Enviados {sent} de {len(messages)} mensajes",
+            "sent": sent,
+            "total": len(messages),
+            "results": results
+        }
+
+    async def send_template(self, template_msg: EmailMessage, recipients: List[str]) -> dict:
+        """Fan-out de un mismo mensaje a N destinatarios (ej. newsletter).
+
+        El mensaje llega ya armado y se serializa UNA sola vez; el armado
+        MIME y as_bytes, que dominan el CPU por envío en mensajes chicos,
+        se amortizan entre todos los destinatarios. Cada uno recibe su
+        propia copia (sobre SMTP individual) sobre la misma sesión
+        autenticada; el header To del template no se toca, como en un Bcc.
+        """
+        raw = template_msg.as_bytes(policy=SMTP_POLICY)
+        results = []
+        sent = 0
+
+        try:
+            async with self._acquire() as smtp:
+                for recipient in recipients:
+                    try:
+                        await smtp.sendmail(self.sender_email, [recipient], raw)
+                        sent += 1
+                        results.append({"recipient": recipient, "status": "success"})
+                    except aiosmtplib.SMTPServerDisconnected:
+                        # Sin conexión no tiene sentido seguir con el fan-out
+                        results.append({"recipient": recipient, "status": "error", "message": "Conexión perdida durante el fan-out"})
+                        raise
+                    except aiosmtplib.SMTPException as e:
+                        # Fallo de este destinatario: resetear la sesión y seguir
+                        results.append({"recipient": recipient, "status": "error", "message": str(e)})
+                        await smtp.rset()
+        except aiosmtplib.SMTPException as e:
+            error_msg = f"Error enviando template via {self.smtp_server}:{self.smtp_port}: {str(e)}"
+            self.logger.error(error_msg)
+            # Los destinatarios que no llegaron a intentarse quedan marcados
+            for recipient in recipients[len(results):]:
+                results.append({"recipient": recipient, "status": "error", "message": error_msg})
+
+        status = "success" if sent == len(recipients) else ("partial" if sent else "error")
+        self.logger.info("Template enviado: %s/%s destinatarios via %s:%s", sent, len(recipients), self.smtp_server, self.smtp_port)
+
+        return {
+            "status": status,
+            "message": f"Enviado a {sent} de {len(recipients)} destinatarios",
+            "sent": sent,
+            "total": len(recipients),
+            "results": results
+        }
+
+    async def send_simple_email(self, to_email: str, subject: str, body: str) -> dict:
+        """Método simplificado para envío básico de emails"""
+        return await self.send_email([to_email], subject, body)
+
+    async def send_via_sendgrid_api(
+        self,
+        to_email: str,
+        subject: str,
+        body: str,
+        is_html: bool = False
+    ) -> dict:
+        """Alternativa usando SendGrid API cuando SMTP falla (no bloqueante)"""
+        if not self.sendgrid_api_key:
+            return {
+                "status": "error",
+                "error_type": "config_missing",
+                "message": "SENDGRID_API_KEY no configurado. Configúralo en Railway para usar esta alternativa.",
+                "solution": "Agrega SENDGRID_API_KEY en Railway → Settings → Variables"
+            }
+
+        if not self.sender_email:
+            return {
+                "status": "error",
+                "error_type": "sender_missing",
+                "message": "EMAIL_FROM no configurado",
+                "solution": "Configura EMAIL_FROM en las variables de entorno"
+            }
+
+        try:
+            url = "https://api.sendgrid.com/v3/mail/send"
+
+            content_type = "text/html" if is_html else "text/plain"
+
+            data = {
+                "personalizations": [{
+                    "to": [{"email": to_email}]
+                }],
+                "from": {
+                    "email": self.sender_email,
+                    "name": self.sender_name
+                },
+                "subject": subject,
+                "content": [{
+                    "type": content_type,
+                    "value": body
+                }]
+            }
+
+            headers = {
+                "Authorization": f"Bearer {self.sendgrid_api_key}",
+                "Content-Type": "application/json"
+            }
+
+            self.logger.info("Enviando email via SendGrid API de %s a %s", self.sender_email, to_email)
+            # Serializar con orjson en vez de json=: emite bytes directo
+            # (sin paso str->bytes) y el recorrido de dicts es a nivel C
+            response = await _get_sg_client().post(url, headers=headers, content=orjson.dumps(data))
+
+            return handle_sendgrid_response(response, self.sender_email, to_email, subject)
+
+        except httpx.ConnectError as e:
+            return {
+                "status": "error",
+                "error_type": "connection_error",
+                "message": "No se pudo conectar a SendGrid API",
+                "details": str(e),
+                "solution": "Verifica la conexión a internet desde Railway"
+            }
+        except httpx.TimeoutException as e:
+            return {
+                "status": "error",
+                "error_type": "timeout",
+                "message": "Timeout conectando a SendGrid API",
+                "details": str(e)
+            }
+        except Exception as e:
+            self.logger.error("Error inesperado con SendGrid API: %s", str(e))
+            return {
+                "status": "error",
+                "error_type": "unexpected_error",
+                "message": f"Error inesperado con SendGrid API: {str(e)}"
+            }
+
+    async def close_all(self):
+        """Cerrar todas las conexiones de los pools (llamar al apagar la aplicación)"""
+        for pool in self._pools.values():
+            while not pool.empty():
+                smtp = pool.get_nowait()
+                if smtp is not None and smtp.is_connected:
+                    try:
+                        await smtp.quit()
+                    except aiosmtplib.SMTPException:
+                        pass
+        self._pools.clear()
@@ -1,38 +1,56 @@
+import functools
 import os
+from dataclasses import dataclass
 from dotenv import load_dotenv
 
 load_dotenv()
 
+@dataclass(frozen=True, slots=True)
 class Config:
     # Configuración SMTP
-    SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
-    SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
-    SMTP_USERNAME = os.getenv("SMTP_USERNAME")
-    SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
-    SENDER_EMAIL = os.getenv("SENDER_EMAIL")
-    SENDER_NAME = os.getenv("SENDER_NAME", "Email Sender API")
-    SENDGRID_API_KEY = os.getenv("SENDGRID_API_KEY")
-    
+    SMTP_SERVER: str
+    SMTP_PORT: int
+    SMTP_USERNAME: str
+    SMTP_PASSWORD: str
+    SENDER_EMAIL: str
+    SENDER_NAME: str
+    SENDGRID_API_KEY: str
+
     # Configuración API
-    API_HOST = os.getenv("API_HOST", "0.0.0.0")
-    API_PORT = int(os.getenv("API_PORT", "8000"))
-    
-    @classmethod
-    def validate_config(cls):
-        """Valida que la configuración esencial esté presente"""
-        required_vars = [
-            ("SMTP_USERNAME", cls.SMTP_USERNAME),
-            ("SMTP_PASSWORD", cls.SMTP_PASSWORD),
-            ("SENDER_EMAIL", cls.SENDER_EMAIL),
-            ("SENDGRID_API_KEY", cls.SENDGRID_API_KEY)
-        ]
-        
-        missing_vars = []
-        for var_name, var_value in required_vars:
-            if not var_value:
-                missing_vars.append(var_name)
-        
-        if missing_vars:
-            raise ValueError(f"Variables de entorno faltantes: {', '.join(missing_vars)}")
-        
-        return True
\ No newline at end of file
+    API_HOST: str
+    API_PORT: int
+
+# Configuración congelada una sola vez al importar: los envs no cambian
+# durante la vida del proceso, y los slots dan acceso directo a atributos
+CONFIG = Config(
+    SMTP_SERVER=os.getenv("SMTP_SERVER", "smtp.gmail.com"),
+    SMTP_PORT=int(os.getenv("SMTP_PORT", "587")),
+    SMTP_USERNAME=os.getenv("SMTP_USERNAME"),
+    SMTP_PASSWORD=os.getenv("SMTP_PASSWORD"),
+    SENDER_EMAIL=os.getenv("SENDER_EMAIL"),
+    SENDER_NAME=os.getenv("SENDER_NAME", "Email Sender API"),
+    SENDGRID_API_KEY=os.getenv("SENDGRID_API_KEY"),
+    API_HOST=os.getenv("API_HOST", "0.0.0.0"),
+    API_PORT=int(os.getenv("API_PORT", "8000")),
+)
+
+@functools.lru_cache(maxsize=1)
+def validate_config() -> bool:
+    """Valida que la configuración esencial esté presente.
+
+    El resultado se memoiza: la configuración es inmutable, así que
+    validarla una vez alcanza aunque se llame por request.
+    """
+    required_vars = [
+        ("SMTP_USERNAME", CONFIG.SMTP_USERNAME),
+        ("SMTP_PASSWORD", CONFIG.SMTP_PASSWORD),
+        ("SENDER_EMAIL", CONFIG.SENDER_EMAIL),
+        ("SENDGRID_API_KEY", CONFIG.SENDGRID_API_KEY)
+    ]
+
+    missing_vars = [var_name for var_name, var_value in required_vars if not var_value]
+
+    if missing_vars:
+        raise ValueError(f"Variables de entorno faltantes: {', '.join(missing_vars)}")
+
+    return True
@@ -1,17 +1,283 @@
+import base64
+import concurrent.futures
+import errno
+import functools
+import io
+import mmap
+import re
 import smtplib
+import stat
 import ssl
 import socket
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email import encoders
+import threading
+import time
+from email import policy
+from itertools import chain
+from email.message import EmailMessage
+from email.utils import formataddr
 import os
 from typing import List, Optional
 import logging
+import orjson
 import requests
 
+logger = logging.getLogger(__name__)
+
+# Timeout explícito por conexión: sin esto un host muerto bloquea minutos
+# (timeout por defecto del SO) antes de permitir probar el siguiente servidor
+SMTP_TIMEOUT = 10
+
+# Los resultados de conectividad valen durante este tiempo: un host que
+# respondió hace segundos casi seguro sigue respondiendo
+REACHABILITY_TTL = 60
+
+# Serializar con finales de línea CRLF como exige SMTP: al enviar bytes
+# crudos, smtplib ya no normaliza los EOL por nosotros
+SMTP_POLICY = policy.SMTP
+
+# Detección de errores de identidad del remitente en respuestas de SendGrid:
+# un solo escaneo a nivel C en vez de dos búsquedas sobre .lower()
+_SENDER_IDENTITY_RE = re.compile(r'sender identity|from address', re.IGNORECASE)
+
+# Reciclado de conexiones del pool: muchos proveedores cortan la conexión
+# alrededor de los 10k mensajes o la limitan por tiempo, así que conviene
+# rotarla nosotros antes de chocar con ese límite
+MAX_MESSAGES_PER_CONNECTION = 10_000
+MAX_CONNECTION_AGE = 1800  # segundos
+
+# A partir de este tamaño los adjuntos se mapean con mmap: el kernel pagina
+# bajo demanda durante la codificación base64 en vez de copiar a un buffer
+MMAP_THRESHOLD = 1 << 20  # 1 MB
+
+def build_message(
+    from_header: str,
+    to_emails: List[str],
+    subject: str,
+    body: str,
+    cc_emails: Optional[List[str]] = None,
+    attachments: Optional[List[str]] = None,
+    is_html: bool = False
+) -> EmailMessage:
+    """Construir el árbol MIME completo (cuerpo + adjuntos).
+
+    Función a nivel de módulo para que los servicios síncrono y asíncrono
+    compartan exactamente el mismo camino de construcción de mensajes.
+    from_header viene ya formateado (formataddr) por el servicio.
+    """
+    # EmailMessage (API moderna) en vez de las clases legacy email.mime.*:
+    # serializa más rápido y maneja unicode/plegado de headers solo
+    msg = EmailMessage()
+    msg['From'] = from_header
+    msg['To'] = ", ".join(to_emails)
+    msg['Subject'] = subject
+
+    if cc_emails:
+        msg['Cc'] = ", ".join(cc_emails)
+
+    # Agregar el cuerpo del mensaje. Con no-ASCII el default elegiría
+    # CTE 8bit (UTF-8 crudo en el DATA), pero sendmail no negocia
+    # 8BITMIME con el servidor: quoted-printable explícito mantiene el
+    # mensaje limpio en 7 bits para cualquier MTA
+    subtype = 'html' if is_html else 'plain'
+    if body.isascii():
+        msg.set_content(body, subtype=subtype)
+    else:
+        msg.set_content(body, subtype=subtype, cte='quoted-printable')
+
+    # Agregar archivos adjuntos si los hay. Se codifican en base64 por
+    # chunks en lugar de leer el archivo completo y recodificarlo: mismo
+    # resultado RFC-compliant con una fracción de la memoria pico.
+    # Los chunks son múltiplos de 57 bytes para que las líneas base64
+    # queden alineadas a 76 caracteres.
+    if attachments:
+        msg.make_mixed()
+        for file_path in attachments:
+            # Un solo stat por adjunto: decide existencia, tipo y tamaño
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                buf = io.BytesIO()
+                with open(file_path, "rb") as attachment:
+                    if st.st_size > MMAP_THRESHOLD:
+                        # Archivos grandes: mmap en vez de read() para que
+                        # las páginas entren bajo demanda, sin doble buffer
+                        with mmap.mmap(attachment.fileno(), st.st_size, access=mmap.ACCESS_READ) as mm:
+                            for offset in range(0, st.st_size, 57 * 1024):
+                                buf.write(base64.encodebytes(mm[offset:offset + 57 * 1024]))
+                    else:
+                        for chunk in iter(lambda: attachment.read(57 * 1024), b''):
+                            buf.write(base64.encodebytes(chunk))
+
+                part = EmailMessage()
+                part['Content-Type'] = 'application/octet-stream'
+                part['Content-Transfer-Encoding'] = 'base64'
+                part['Content-Disposition'] = f'attachment; filename="{os.path.basename(file_path)}"'
+                part.set_payload(buf.getvalue().decode('ascii'))
+                msg.attach(part)
+
+    return msg
+
+def collect_recipients(
+    to_emails: List[str],
+    cc_emails: Optional[List[str]] = None,
+    bcc_emails: Optional[List[str]] = None
+) -> List[str]:
+    """Preparar la lista completa de destinatarios (To + Cc + Bcc).
+
+    Deduplica preservando el orden: un destinatario repetido entre To/Cc/Bcc
+    costaría un RCPT TO extra (un round-trip) y el mensaje le llegaría dos
+    veces. La comparación ignora mayúsculas pero se envía la forma original.
+    """
+    seen = {}
+    for address in chain(to_emails, cc_emails or (), bcc_emails or ()):
+        seen.setdefault(address.lower(), address)
+    return list(seen.values())
+
+def handle_sendgrid_response(response, sender_email: str, to_email: str, subject: str) -> dict:
+    """Traducir una respuesta de la API de SendGrid al dict de resultado.
+
+    Compartida por los servicios síncrono (requests) y asíncrono (httpx):
+    ambos exponen status_code / json() / text.
+    """
+    if response.status_code == 202:
+        logger.info("Email enviado exitosamente via SendGrid API a %s", to_email)
+        return {
+            "status": "success",
+            "message": f"Email enviado via SendGrid API a {to_email}",
+            "method": "sendgrid_api",
+            "recipient": to_email
+        }
+    elif response.status_code == 401:
+        return {
+            "status": "error",
+            "error_type": "authentication",
+            "message": "API Key de SendGrid inválida",
+            "solution": "Verifica que SENDGRID_API_KEY sea correcta en Railway"
+        }
+    elif response.status_code == 403:
+        try:
+            error_data = response.json()
+            errors = error_data.get('errors', [])
+
+            # Verificar si es problema de identidad del remitente
+            sender_identity_error = False
+            for error in errors:
+                if _SENDER_IDENTITY_RE.search(error.get('message', '')):
+                    sender_identity_error = True
+                    break
+
+            if sender_identity_error:
+                return {
+                    "status": "error",
+                    "error_type": "sender_not_verified",
+                    "message": f"El email {sender_email} no está verificado en SendGrid",
+                    "sendgrid_errors": errors,
+                    "solution": {
+                        "step_1": "Ve a https://app.sendgrid.com/settings/sender_auth",
+                        "step_2": "Click en 'Verify a Single Sender'",
+                        "step_3": f"Verifica el email: {sender_email}",
+                        "step_4": "Revisa tu email y confirma la verificación",
+                        "step_5": "Asegúrate de que EMAIL_FROM coincida exactamente con el email verificado"
+                    }
+                }
+            else:
+                return {
+                    "status": "error",
+                    "error_type": "forbidden",
+                    "message": "Acceso denegado por SendGrid",
+                    "sendgrid_errors": errors,
+                    "response_code": response.status_code
+                }
+        except:
+            return {
+                "status": "error",
+                "error_type": "forbidden",
+                "message": f"SendGrid API error 403: {response.text}",
+                "solution": "Verifica la configuración de SendGrid Sender Authentication"
+            }
+    elif response.status_code == 400:
+        try:
+            error_data = response.json()
+            return {
+                "status": "error",
+                "error_type": "bad_request",
+                "message": "Error en los datos enviados a SendGrid",
+                "sendgrid_errors": error_data.get('errors', []),
+                "sent_data": {
+                    "from": sender_email,
+                    "to": to_email,
+                    "subject": subject
+                }
+            }
+        except:
+            return {
+                "status": "error",
+                "error_type": "bad_request",
+                "message": f"SendGrid API error 400: {response.text}"
+            }
+    else:
+        return {
+            "status": "error",
+            "error_type": f"api_error_{response.status_code}",
+            "message": f"SendGrid API error: {response.status_code}",
+            "response": response.text[:500] if len(response.text) > 500 else response.text
+        }
+
+class _TokenBucket:
+    """Token bucket simple, compartido entre threads, para limitar envíos/seg"""
+
+    def __init__(self, rate_per_sec: float, capacity: Optional[float] = None):
+        self.rate = rate_per_sec
+        self.capacity = capacity if capacity is not None else max(1.0, rate_per_sec)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0):
+        """Bloquear hasta que haya tokens disponibles"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+class _PooledSMTP:
+    """Conexión SMTP del pool con contadores para decidir su reciclado"""
+
+    def __init__(self, server: smtplib.SMTP):
+        self.server = server
+        self.sent_count = 0
+        self.created_at = time.monotonic()
+
+    def is_stale(self) -> bool:
+        return (
+            self.sent_count >= MAX_MESSAGES_PER_CONNECTION
+            or time.monotonic() - self.created_at > MAX_CONNECTION_AGE
+        )
+
+@functools.lru_cache(maxsize=32)
+def _resolve_host(server: str, port: int):
+    """Resolver DNS una sola vez por (host, puerto); los MX no cambian seguido"""
+    return socket.getaddrinfo(server, port, type=socket.SOCK_STREAM)
+
 class EmailService:
-    def __init__(self, smtp_server: str, smtp_port: int, username: str, password: str, sender_email: str, sender_name: str, sendgrid_api_key: str):
+    # Alternativas de configuración para Railway. Tupla a nivel de clase:
+    # es invariante, no hace falta una lista nueva por instancia
+    fallback_configs = (
+        {'server': 'smtp.gmail.com', 'port': 587, 'ssl': False},
+        {'server': 'smtp.gmail.com', 'port': 465, 'ssl': True},
+        {'server': 'smtp-mail.outlook.com', 'port': 587, 'ssl': False},
+        {'server': 'smtp.sendgrid.net', 'port': 587, 'ssl': False},
+    )
+
+    def __init__(self, smtp_server: str, smtp_port: int, username: str, password: str, sender_email: str, sender_name: str, sendgrid_api_key: str, hedge_delay: float = 3.0):
         self.smtp_server = smtp_server
         self.smtp_port = smtp_port
         self.username = username
@@ -19,53 +285,168 @@ class EmailService:
         self.sender_email = sender_email
         self.sender_name = sender_name
         self.sendgrid_api_key = sendgrid_api_key
-        
-        logging.basicConfig(level=logging.INFO)
-        self.logger = logging.getLogger(__name__)
-        
-        # Alternativas de configuración para Railway
-        self.fallback_configs = [
-            {'server': 'smtp.gmail.com', 'port': 587, 'ssl': False},
-            {'server': 'smtp.gmail.com', 'port': 465, 'ssl': True},
-            {'server': 'smtp-mail.outlook.com', 'port': 587, 'ssl': False},
-            {'server': 'smtp.sendgrid.net', 'port': 587, 'ssl': False},
-        ]
-    
+        # Segundos de gracia antes de lanzar especulativamente el siguiente
+        # servidor mientras el anterior sigue en vuelo (hedged requests)
+        self.hedge_delay = hedge_delay
+
+        # Invariantes por instancia: el header From formateado (RFC 2047 si
+        # el nombre lleva no-ASCII) y el contexto TLS, que al crearse lee y
+        # parsea el trust store del sistema — una vez alcanza
+        self._from_header = formataddr((sender_name, sender_email))
+        self._ssl_ctx = ssl.create_default_context()
+
+        self.logger = logger
+
+        # Especialización por cuenta: la lista de servidores candidatos es
+        # fija para la vida del servicio, así que se evalúa una sola vez acá
+        # en vez de reconstruirla y filtrarla en cada envío
+        self._send_configs = [(self.smtp_server, self.smtp_port, False)]
+        for config in self.fallback_configs:
+            if config['server'] == self.smtp_server and config['port'] == self.smtp_port:
+                continue  # Ya está como configuración principal
+            self._send_configs.append((config['server'], config['port'], config['ssl']))
+
+        # Pool de conexiones SMTP persistentes: evita rehacer el handshake
+        # TCP+TLS+AUTH en cada envío. Clave: (servidor, puerto, ssl)
+        self._pool: dict = {}
+        self._pool_locks: dict = {}
+        self._pool_guard = threading.Lock()
+
+        # Cache de reachability por (servidor, puerto) con TTL
+        self._reachability_cache: dict = {}
+
+        # Rate limiters por servidor (Gmail ~100-500/día vs SendGrid 100k/día):
+        # enviar en ráfaga sin freno provoca 421 y termina siendo MÁS lento
+        self._buckets: dict = {}
+
+        # Sesión HTTP persistente hacia SendGrid: reutiliza la conexión TLS
+        # (~2 RTT de handshake ahorrados por llamada)
+        self._http = requests.Session()
+
+        # Partes invariantes del envelope de SendGrid, armadas una sola vez
+        self._sg_from = {"email": sender_email, "name": sender_name}
+        self._sg_headers = {
+            "Authorization": f"Bearer {sendgrid_api_key}",
+            "Content-Type": "application/json"
+        } if sendgrid_api_key else None
+
+    def _get_connection_lock(self, key: tuple) -> threading.Lock:
+        """Obtener el lock asociado a una conexión del pool (SMTP es stateful)"""
+        with self._pool_guard:
+            if key not in self._pool_locks:
+                self._pool_locks[key] = threading.Lock()
+            return self._pool_locks[key]
+
+    def _get_or_create_connection(self, smtp_server: str, smtp_port: int, use_ssl: bool) -> _PooledSMTP:
+        """Obtener una conexión autenticada del pool, o crearla si no existe,
+        murió, o ya toca reciclarla por edad/cantidad de mensajes"""
+        key = (smtp_server, smtp_port, use_ssl)
+
+        pooled = self._pool.get(key)
+        if pooled is not None:
+            if pooled.is_stale():
+                # Rotación preventiva antes del límite del proveedor
+                self.logger.info("Reciclando conexión a %s:%s (%s mensajes enviados)", smtp_server, smtp_port, pooled.sent_count)
+                self._discard_connection(key)
+            else:
+                try:
+                    status, _ = pooled.server.noop()
+                    if status == 250:
+                        return pooled
+                except (smtplib.SMTPServerDisconnected, smtplib.SMTPException, OSError):
+                    pass
+                # La conexión cacheada ya no sirve: descartarla
+                self._discard_connection(key)
+
+        # Crear una conexión nueva y autenticarla
+        context = self._ssl_ctx
+
+        if use_ssl:
+            # Conexión SSL directa (puerto 465)
+            server = smtplib.SMTP_SSL(smtp_server, smtp_port, context=context, timeout=SMTP_TIMEOUT)
+        else:
+            # Conexión STARTTLS (puerto 587)
+            server = smtplib.SMTP(smtp_server, smtp_port, timeout=SMTP_TIMEOUT)
+            server.starttls(context=context)
+
+        server.login(self.username, self.password)
+
+        pooled = _PooledSMTP(server)
+        self._pool[key] = pooled
+        return pooled
+
+    def _discard_connection(self, key: tuple):
+        """Quitar una conexión del pool, cerrándola si todavía responde"""
+        pooled = self._pool.pop(key, None)
+        if pooled is not None:
+            try:
+                pooled.server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+
+    def _get_bucket(self, smtp_server: str) -> Optional[_TokenBucket]:
+        """Obtener el token bucket del servidor, creado desde SMTP_RATE_<HOST>.
+
+        Ejemplo: SMTP_RATE_SMTP_GMAIL_COM=0.5 limita gmail a un envío cada
+        2 segundos. Sin variable configurada no se aplica límite.
+        """
+        if smtp_server not in self._buckets:
+            env_key = "SMTP_RATE_" + re.sub(r'[^A-Z0-9]', '_', smtp_server.upper())
+            rate = os.getenv(env_key)
+            self._buckets[smtp_server] = _TokenBucket(float(rate)) if rate else None
+        return self._buckets[smtp_server]
+
+    def close_all(self):
+        """Cerrar todas las conexiones del pool (llamar al apagar la aplicación)"""
+        for key in list(self._pool.keys()):
+            self._discard_connection(key)
+        self._http.close()
+
     def test_connectivity(self) -> dict:
-        """Probar conectividad a diferentes servidores SMTP"""
-        results = {}
-        
-        # Probar configuración actual
-        current_config = f"{self.smtp_server}:{self.smtp_port}"
-        results[current_config] = self._test_smtp_connection(self.smtp_server, self.smtp_port)
-        
-        # Probar configuraciones alternativas
+        """Probar conectividad a diferentes servidores SMTP (en paralelo)"""
+        # Configuración actual primero, luego las alternativas sin repetir
+        targets = [(self.smtp_server, self.smtp_port)]
         for config in self.fallback_configs:
-            config_name = f"{config['server']}:{config['port']}"
-            if config_name != current_config:
-                results[config_name] = self._test_smtp_connection(config['server'], config['port'])
-        
-        return results
-    
+            if (config['server'], config['port']) not in targets:
+                targets.append((config['server'], config['port']))
+
+        # Las pruebas corren en paralelo: el total tarda lo que el host más
+        # lento, no la suma de todos
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            probes = executor.map(lambda t: self._test_smtp_connection(t[0], t[1]), targets)
+            return {f"{server}:{port}": probe for (server, port), probe in zip(targets, probes)}
+
     def _test_smtp_connection(self, server: str, port: int, timeout: int = 10) -> dict:
-        """Probar conexión a un servidor SMTP específico"""
+        """Probar conexión a un servidor SMTP específico (con cache por TTL)"""
+        # Resultado reciente en cache: no volver a abrir el socket
+        cached = self._reachability_cache.get((server, port))
+        if cached is not None:
+            cached_at, result = cached
+            if time.monotonic() - cached_at < REACHABILITY_TTL:
+                return result
+
         try:
-            self.logger.info(f"Probando conexión a {server}:{port}")
-            
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.logger.info("Probando conexión a %s:%s", server, port)
+
+            # Resolver una sola vez y conectar directo a la IP cacheada
+            family, socktype, proto, _, sockaddr = _resolve_host(server, port)[0]
+            sock = socket.socket(family, socktype, proto)
             sock.settimeout(timeout)
-            result = sock.connect_ex((server, port))
+            code = sock.connect_ex(sockaddr)
             sock.close()
-            
-            if result == 0:
-                return {"status": "reachable", "message": "Conexión exitosa"}
+
+            if code == 0:
+                result = {"status": "reachable", "message": "Conexión exitosa"}
             else:
-                return {"status": "unreachable", "message": f"Error de conexión: {result}"}
-                
+                result = {"status": "unreachable", "message": f"Error de conexión: {code}"}
+
         except socket.gaierror as e:
-            return {"status": "dns_error", "message": f"Error DNS: {str(e)}"}
+            result = {"status": "dns_error", "message": f"Error DNS: {str(e)}"}
         except Exception as e:
-            return {"status": "error", "message": f"Error: {str(e)}"}
+            result = {"status": "error", "message": f"Error: {str(e)}"}
+
+        self._reachability_cache[(server, port)] = (time.monotonic(), result)
+        return result
     
     def send_email(
         self,
@@ -79,37 +460,30 @@ class EmailService:
         use_fallback: bool = True
     ) -> dict:
         """Enviar email con fallback automático si la conexión principal falla"""
-        
-        # Intentar con configuración principal
-        result = self._attempt_send_email(
-            self.smtp_server, self.smtp_port, False,
-            to_emails, subject, body, cc_emails, bcc_emails, attachments, is_html
-        )
-        
-        if result["status"] == "success":
-            return result
-        
+
+        # Construir y serializar el mensaje UNA sola vez: rearmar el árbol
+        # MIME (y re-codificar adjuntos en base64) por cada intento de
+        # fallback es puro recómputo
+        msg = build_message(self._from_header, to_emails, subject, body, cc_emails, attachments, is_html)
+        # as_bytes() aplana el mensaje directo a bytes (BytesGenerator), sin
+        # el paso str->bytes de as_string()+sendmail(str). Los Bcc nunca se
+        # agregan como header, así que no pueden filtrarse en el DATA: viajan
+        # solo como RCPT TO vía all_recipients
+        raw = msg.as_bytes(policy=SMTP_POLICY)
+        all_recipients = collect_recipients(to_emails, cc_emails, bcc_emails)
+
         if not use_fallback:
-            return result
-        
-        # Si falla, intentar con configuraciones alternativas
-        self.logger.warning(f"Fallo principal: {result['message']}. Intentando configuraciones alternativas...")
-        
-        for config in self.fallback_configs:
-            if config['server'] == self.smtp_server and config['port'] == self.smtp_port:
-                continue  # Ya intentamos esta configuración
-            
-            self.logger.info(f"Intentando con {config['server']}:{config['port']}")
-            
-            result = self._attempt_send_email(
-                config['server'], config['port'], config['ssl'],
-                to_emails, subject, body, cc_emails, bcc_emails, attachments, is_html
+            return self._attempt_send_raw(
+                self.smtp_server, self.smtp_port, False, all_recipients, raw
             )
-            
-            if result["status"] == "success":
-                result["fallback_used"] = f"{config['server']}:{config['port']}"
-                return result
-        
+
+        # Con fallback habilitado, los servidores se intentan de forma
+        # escalonada en paralelo en vez de estrictamente en secuencia
+        result = self._send_hedged(self._send_configs, all_recipients, raw)
+
+        if result["status"] == "success":
+            return result
+
         # Si todos fallan, sugerir usar API
         return {
             "status": "error",
@@ -117,76 +491,202 @@ class EmailService:
             "suggestion": "use_sendgrid_api",
             "connectivity_test": self.test_connectivity()
         }
-    
-    def _attempt_send_email(
+
+    def _send_hedged(self, configs: List[tuple], all_recipients: List[str], raw: bytes) -> dict:
+        """Intentar servidores en paralelo escalonado (hedged requests).
+
+        El principal arranca de inmediato y, cada hedge_delay segundos sin
+        éxito, se lanza especulativamente el siguiente. El primer éxito gana;
+        así un servidor colgado no bloquea a las alternativas hasta el timeout.
+        """
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(configs))
+        # Señal de aborto compartida: cuando un intento gana, los demás la
+        # ven antes de transmitir y desisten. Sin esto, un principal sano
+        # pero más lento que hedge_delay entregaría el mensaje DOS veces
+        # (él y el fallback especulativo)
+        abort = threading.Event()
+        try:
+            pending = set()
+            key_by_future = {}
+            last_result = None
+            idx = 0
+
+            while idx < len(configs) or pending:
+                if idx < len(configs):
+                    smtp_server, smtp_port, use_ssl = configs[idx]
+                    if idx > 0:
+                        self.logger.info("Intentando también con %s:%s", smtp_server, smtp_port)
+                    future = executor.submit(
+                        self._attempt_send_raw, smtp_server, smtp_port, use_ssl, all_recipients, raw, abort
+                    )
+                    key_by_future[future] = (smtp_server, smtp_port, use_ssl)
+                    pending.add(future)
+                    idx += 1
+
+                # Mientras queden servidores por lanzar, esperar solo el
+                # período de gracia; después, esperar a que terminen todos
+                wait_timeout = self.hedge_delay if idx < len(configs) else None
+                done, pending = concurrent.futures.wait(pending, timeout=wait_timeout)
+
+                for future in done:
+                    result = future.result()
+                    server_key = key_by_future[future]
+                    if result["status"] == "success":
+                        abort.set()
+                        # Cortar en caliente los sockets de los perdedores
+                        # todavía en vuelo: un sendmail bloqueado sale con
+                        # SMTPServerDisconnected y ve el aborto al reintentar
+                        for loser in pending:
+                            pooled = self._pool.pop(key_by_future[loser], None)
+                            if pooled is not None:
+                                try:
+                                    pooled.server.close()
+                                except OSError:
+                                    pass
+                        if server_key[:2] != (self.smtp_server, self.smtp_port):
+                            result["fallback_used"] = f"{server_key[0]}:{server_key[1]}"
+                        return result
+                    if result["status"] != "aborted":
+                        self.logger.warning("Fallo %s:%s: %s", server_key[0], server_key[1], result['message'])
+                        last_result = result
+
+            return last_result
+        finally:
+            # Señalizar aborto también al salir por error: que ningún
+            # intento rezagado transmita después de devolver el resultado
+            abort.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _send_pipelined(self, server: smtplib.SMTP, from_addr: str, recipients: List[str], raw: bytes):
+        """Enviar MAIL FROM + todos los RCPT TO + DATA en una sola escritura.
+
+        Con la extensión PIPELINING (RFC 2920) el servidor acepta los
+        comandos en lote y las respuestas se leen después en orden: los
+        N+2 round-trips del envío normal se colapsan en ~2. Solo tiene
+        sentido con varios destinatarios en enlaces con latencia.
+        """
+        batch = [f"MAIL FROM:{smtplib.quoteaddr(from_addr)}\r\n"]
+        batch.extend(f"RCPT TO:{smtplib.quoteaddr(recipient)}\r\n" for recipient in recipients)
+        batch.append("DATA\r\n")
+        server.send(''.join(batch))
+
+        # Leer SIEMPRE las N+2 respuestas, en el mismo orden en que se
+        # escribieron los comandos, ANTES de decidir si algo falló: levantar
+        # una excepción dejando respuestas sin leer desincroniza la sesión,
+        # y la conexión queda en el pool (su noop() consumiría una respuesta
+        # vieja y pasaría el health-check igual)
+        mail_code, mail_resp = server.getreply()
+
+        refused = {}
+        for recipient in recipients:
+            code, resp = server.getreply()
+            if code not in (250, 251):
+                refused[recipient] = (code, resp)
+
+        data_code, data_resp = server.getreply()
+
+        if data_code == 354:
+            if mail_code == 250 and len(refused) < len(recipients):
+                # Mismo dot-stuffing que smtplib.SMTP.data()
+                quoted = re.sub(br'(?m)^\.', b'..', raw)
+                if not quoted.endswith(b"\r\n"):
+                    quoted += b"\r\n"
+                server.send(quoted + b".\r\n")
+                code, resp = server.getreply()
+                if code != 250:
+                    raise smtplib.SMTPDataError(code, resp)
+
+                if refused:
+                    self.logger.warning("Destinatarios rechazados por el servidor: %s", refused)
+                return
+            # MAIL falló o ningún RCPT quedó en pie, pero el servidor abrió
+            # DATA igual: cerrarlo vacío para dejar la sesión limpia
+            server.send(b".\r\n")
+            server.getreply()
+
+        if mail_code != 250:
+            raise smtplib.SMTPSenderRefused(mail_code, mail_resp, from_addr)
+        if refused:
+            # Típicamente DATA respondió 554 porque todos fueron rechazados
+            raise smtplib.SMTPRecipientsRefused(refused)
+        raise smtplib.SMTPDataError(data_code, data_resp)
+
+    def _attempt_send_raw(
         self,
         smtp_server: str,
         smtp_port: int,
         use_ssl: bool,
-        to_emails: List[str],
-        subject: str,
-        body: str,
-        cc_emails: Optional[List[str]] = None,
-        bcc_emails: Optional[List[str]] = None,
-        attachments: Optional[List[str]] = None,
-        is_html: bool = False
+        all_recipients: List[str],
+        raw: bytes,
+        abort: Optional[threading.Event] = None
     ) -> dict:
-        """Intentar enviar email con una configuración específica"""
+        """Intentar enviar un mensaje ya serializado con una configuración específica.
+
+        abort lo comparte _send_hedged entre los intentos escalonados: si
+        otro servidor ya entregó el mensaje, este intento desiste antes de
+        transmitir en vez de generar una entrega duplicada.
+        """
+        def aborted() -> bool:
+            return abort is not None and abort.is_set()
+
         try:
-            msg = MIMEMultipart()
-            msg['From'] = f"{self.sender_name} <{self.sender_email}>"
-            msg['To'] = ", ".join(to_emails)
-            msg['Subject'] = subject
-            
-            if cc_emails:
-                msg['Cc'] = ", ".join(cc_emails)
-            
-            # Agregar el cuerpo del mensaje
-            mime_type = 'html' if is_html else 'plain'
-            msg.attach(MIMEText(body, mime_type, 'utf-8'))
-            
-            # Agregar archivos adjuntos si los hay
-            if attachments:
-                for file_path in attachments:
-                    if os.path.isfile(file_path):
-                        with open(file_path, "rb") as attachment:
-                            part = MIMEBase('application', 'octet-stream')
-                            part.set_payload(attachment.read())
-                        
-                        encoders.encode_base64(part)
-                        part.add_header(
-                            'Content-Disposition',
-                            f'attachment; filename= {os.path.basename(file_path)}'
-                        )
-                        msg.attach(part)
-            
-            # Preparar lista de destinatarios
-            all_recipients = to_emails.copy()
-            if cc_emails:
-                all_recipients.extend(cc_emails)
-            if bcc_emails:
-                all_recipients.extend(bcc_emails)
-            
-            # Configurar conexión SMTP
-            context = ssl.create_default_context()
-            
-            if use_ssl:
-                # Conexión SSL directa (puerto 465)
-                server = smtplib.SMTP_SSL(smtp_server, smtp_port, context=context)
-            else:
-                # Conexión STARTTLS (puerto 587)
-                server = smtplib.SMTP(smtp_server, smtp_port)
-                server.starttls(context=context)
-            
-            # Autenticación
-            server.login(self.username, self.password)
-            
-            # Enviar email
-            text = msg.as_string()
-            server.sendmail(self.sender_email, all_recipients, text)
-            server.quit()
+            if aborted():
+                return {"status": "aborted", "message": f"Intento contra {smtp_server}:{smtp_port} abortado: otro servidor ya entregó el mensaje"}
+
+            # Respetar el límite de tasa del servidor antes de tomar el lock
+            # de la conexión (la espera no debe bloquear a otros servidores)
+            bucket = self._get_bucket(smtp_server)
+            if bucket is not None:
+                bucket.acquire()
+
+            # Enviar usando la conexión persistente del pool.
+            # El lock serializa envíos concurrentes sobre la misma conexión.
+            key = (smtp_server, smtp_port, use_ssl)
+            with self._get_connection_lock(key):
+                def transmit(pooled):
+                    # Con varios destinatarios y PIPELINING anunciado, los
+                    # RCPT TO se mandan en lote (1 round-trip en vez de N)
+                    if len(all_recipients) > 1 and pooled.server.has_extn('pipelining'):
+                        self._send_pipelined(pooled.server, self.sender_email, all_recipients, raw)
+                    else:
+                        pooled.server.sendmail(self.sender_email, all_recipients, raw)
+                    pooled.sent_count += 1
+
+                # Errores transitorios (desconexión, 4xx) se reintentan sobre
+                # el mismo servidor con backoff exponencial: mucho más barato
+                # que pagar el handshake completo contra un proveedor distinto
+                last_error = None
+                for attempt in range(3):
+                    if attempt > 0:
+                        delay = 0.5 * (3 ** (attempt - 1))
+                        self.logger.info("Reintentando %s:%s en %ss (intento %s)", smtp_server, smtp_port, delay, attempt + 1)
+                        time.sleep(delay)
+                    # Re-chequear el aborto antes de conectar y antes de
+                    # transmitir: el handshake puede tardar más que lo que
+                    # tardó otro servidor en entregar el mensaje
+                    if aborted():
+                        return {"status": "aborted", "message": f"Intento contra {smtp_server}:{smtp_port} abortado: otro servidor ya entregó el mensaje"}
+                    try:
+                        pooled = self._get_or_create_connection(smtp_server, smtp_port, use_ssl)
+                        if aborted():
+                            return {"status": "aborted", "message": f"Intento contra {smtp_server}:{smtp_port} abortado: otro servidor ya entregó el mensaje"}
+                        transmit(pooled)
+                        break
+                    except smtplib.SMTPServerDisconnected as e:
+                        # La conexión murió en pleno envío: descartar y
+                        # reconectar en el próximo intento
+                        self._discard_connection(key)
+                        last_error = e
+                    except smtplib.SMTPResponseException as e:
+                        if 400 <= e.smtp_code < 500:
+                            # 4xx = rechazo temporal (throttling, greylisting)
+                            last_error = e
+                        else:
+                            raise
+                else:
+                    raise last_error
             
-            self.logger.info(f"Email enviado exitosamente via {smtp_server}:{smtp_port} a {len(all_recipients)} destinatarios")
+            self.logger.info("Email enviado exitosamente via %s:%s a %s destinatarios", smtp_server, smtp_port, len(all_recipients))
             
             return {
                 "status": "success",
@@ -206,7 +706,9 @@ class EmailService:
             return {"status": "connection_error", "message": error_msg}
             
         except OSError as e:
-            if "Network is unreachable" in str(e):
+            # Clasificar por errno en vez de buscar substrings en el mensaje
+            # (que depende del locale y formatea la excepción aunque no se use)
+            if e.errno == errno.ENETUNREACH:
                 error_msg = f"Red no alcanzable para {smtp_server}:{smtp_port}. Railway podría estar bloqueando este puerto."
                 self.logger.error(error_msg)
                 return {"status": "network_unreachable", "message": error_msg}
@@ -253,116 +755,28 @@ class EmailService:
         
         try:
             url = "https://api.sendgrid.com/v3/mail/send"
-            
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
-            
+
             content_type = "text/html" if is_html else "text/plain"
-            
-            data = {
+
+            # Serializar con orjson y mandar bytes directamente: evita el
+            # json.dumps interno de requests; from/headers ya están armados
+            payload = orjson.dumps({
                 "personalizations": [{
                     "to": [{"email": to_email}]
                 }],
-                "from": {
-                    "email": self.sender_email,
-                    "name": self.sender_name
-                },
+                "from": self._sg_from,
                 "subject": subject,
                 "content": [{
                     "type": content_type,
                     "value": body
                 }]
-            }
-            
-            self.logger.info(f"Enviando email via SendGrid API de {self.sender_email} a {to_email}")
-            response = requests.post(url, headers=headers, json=data)
-            
-            if response.status_code == 202:
-                self.logger.info(f"Email enviado exitosamente via SendGrid API a {to_email}")
-                return {
-                    "status": "success",
-                    "message": f"Email enviado via SendGrid API a {to_email}",
-                    "method": "sendgrid_api",
-                    "recipient": to_email
-                }
-            elif response.status_code == 401:
-                return {
-                    "status": "error",
-                    "error_type": "authentication",
-                    "message": "API Key de SendGrid inválida",
-                    "solution": "Verifica que SENDGRID_API_KEY sea correcta en Railway"
-                }
-            elif response.status_code == 403:
-                try:
-                    error_data = response.json()
-                    errors = error_data.get('errors', [])
-                    
-                    # Verificar si es problema de identidad del remitente
-                    sender_identity_error = any(
-                        'sender identity' in error.get('message', '').lower() or
-                        'from address' in error.get('message', '').lower()
-                        for error in errors
-                    )
-                    
-                    if sender_identity_error:
-                        return {
-                            "status": "error",
-                            "error_type": "sender_not_verified",
-                            "message": f"El email {self.sender_email} no está verificado en SendGrid",
-                            "sendgrid_errors": errors,
-                            "solution": {
-                                "step_1": "Ve a https://app.sendgrid.com/settings/sender_auth",
-                                "step_2": "Click en 'Verify a Single Sender'",
-                                "step_3": f"Verifica el email: {self.sender_email}",
-                                "step_4": "Revisa tu email y confirma la verificación",
-                                "step_5": "Asegúrate de que EMAIL_FROM coincida exactamente con el email verificado"
-                            }
-                        }
-                    else:
-                        return {
-                            "status": "error",
-                            "error_type": "forbidden",
-                            "message": "Acceso denegado por SendGrid",
-                            "sendgrid_errors": errors,
-                            "response_code": response.status_code
-                        }
-                except:
-                    return {
-                        "status": "error",
-                        "error_type": "forbidden",
-                        "message": f"SendGrid API error 403: {response.text}",
-                        "solution": "Verifica la configuración de SendGrid Sender Authentication"
-                    }
-            elif response.status_code == 400:
-                try:
-                    error_data = response.json()
-                    return {
-                        "status": "error",
-                        "error_type": "bad_request",
-                        "message": "Error en los datos enviados a SendGrid",
-                        "sendgrid_errors": error_data.get('errors', []),
-                        "sent_data": {
-                            "from": self.sender_email,
-                            "to": to_email,
-                            "subject": subject
-                        }
-                    }
-                except:
-                    return {
-                        "status": "error",
-                        "error_type": "bad_request",
-                        "message": f"SendGrid API error 400: {response.text}"
-                    }
-            else:
-                return {
-                    "status": "error",
-                    "error_type": f"api_error_{response.status_code}",
-                    "message": f"SendGrid API error: {response.status_code}",
-                    "response": response.text[:500] if len(response.text) > 500 else response.text
-                }
-            
+            })
+
+            self.logger.info("Enviando email via SendGrid API de %s a %s", self.sender_email, to_email)
+            response = self._http.post(url, headers=self._sg_headers, data=payload, timeout=10)
+
+            return handle_sendgrid_response(response, self.sender_email, to_email, subject)
+
         except requests.exceptions.ConnectionError as e:
             return {
                 "status": "error",
@@ -379,7 +793,7 @@ class EmailService:
                 "details": str(e)
             }
         except Exception as e:
-            self.logger.error(f"Error inesperado con SendGrid API: {str(e)}")
+            self.logger.error("Error inesperado con SendGrid API: %s", str(e))
             return {
                 "status": "error",
                 "error_type": "unexpected_error",
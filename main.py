@@ -1,15 +1,25 @@
 from fastapi import FastAPI, HTTPException, UploadFile, File
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, field_validator
+from email_validator import validate_email
 from typing import List, Optional
+from functools import lru_cache
 import os
 from dotenv import load_dotenv
 from email_service import EmailService
+from async_email_service import AsyncEmailService, close_sg_client
+import logging
 import tempfile
 import uuid
 
 # Cargar variables de entorno
 load_dotenv()
 
+# Configurar logging UNA sola vez en el entry point: los módulos de
+# servicio solo crean loggers (getLogger) y sin esta llamada el root
+# logger quedaría en WARNING, descartando los INFO operativos (envíos,
+# reintentos, reciclado de conexiones). uvicorn solo configura los suyos.
+logging.basicConfig(level=logging.INFO)
+
 app = FastAPI(
     title="Email Sender API",
     description="API sencilla para envío de emails",
@@ -25,6 +35,27 @@ class EmailRequest(BaseModel):
     bcc_emails: Optional[List[EmailStr]] = None
     is_html: Optional[bool] = False
 
+# Validar una dirección cuesta IDNA + regex en email-validator; en lotes con
+# destinatarios repetidos el cache evita repagarlo por cada aparición
+@lru_cache(maxsize=10_000)
+def _validate_email_cached(address: str) -> str:
+    return validate_email(address, check_deliverability=False).normalized
+
+class BulkEmailItem(BaseModel):
+    to_emails: List[str]
+    subject: str
+    body: str
+    cc_emails: Optional[List[str]] = None
+    bcc_emails: Optional[List[str]] = None
+    is_html: Optional[bool] = False
+
+    @field_validator('to_emails', 'cc_emails', 'bcc_emails')
+    @classmethod
+    def _validate_addresses(cls, value):
+        if value is None:
+            return value
+        return [_validate_email_cached(address) for address in value]
+
 class SimpleEmailRequest(BaseModel):
     to_email: EmailStr
     subject: str
@@ -35,7 +66,9 @@ class EmailResponse(BaseModel):
     message: str
     recipients: Optional[int] = None
 
-# Configuración del servicio de email
+# Configuración del servicio de email. Instancia única: reconstruirla por
+# request re-lee los envs y, sobre todo, tiraría el pool de conexiones SMTP
+@lru_cache(maxsize=1)
 def get_email_service():
     return EmailService(
         smtp_server=os.getenv("SMTP_SERVER", "smtp.gmail.com"),
@@ -47,6 +80,34 @@ def get_email_service():
         sendgrid_api_key=os.getenv("SENDGRID_API_KEY")
     )
 
+# Instancia única del servicio asíncrono: el pool de conexiones SMTP
+# solo sirve si sobrevive entre requests
+_async_email_service: Optional[AsyncEmailService] = None
+
+def get_async_email_service():
+    global _async_email_service
+    if _async_email_service is None:
+        _async_email_service = AsyncEmailService(
+            smtp_server=os.getenv("SMTP_SERVER", "smtp.gmail.com"),
+            smtp_port=int(os.getenv("SMTP_PORT", "587")),
+            username=os.getenv("SMTP_USERNAME"),
+            password=os.getenv("SMTP_PASSWORD"),
+            sender_email=os.getenv("SENDER_EMAIL"),
+            sender_name=os.getenv("SENDER_NAME", "Email Sender API"),
+            sendgrid_api_key=os.getenv("SENDGRID_API_KEY"),
+            pool_size=int(os.getenv("SMTP_POOL_SIZE", "2"))
+        )
+    return _async_email_service
+
+@app.on_event("shutdown")
+async def shutdown_email_services():
+    """Cerrar las conexiones SMTP de los pools al apagar la aplicación"""
+    if _async_email_service is not None:
+        await _async_email_service.close_all()
+    if get_email_service.cache_info().currsize:
+        get_email_service().close_all()
+    await close_sg_client()
+
 @app.get("/")
 async def root():
     return {
@@ -54,6 +115,7 @@ async def root():
         "version": "1.0.0",
         "endpoints": [
             "/send-email - POST: Envía emails con opciones avanzadas",
+            "/send-bulk - POST: Envía un lote de emails sobre una sola conexión",
             "/send-simple-email - POST: Envía un email simple",
             "/send-email-with-api-fallback - POST: Envía un email con opciones avanzadas usando SendGrid API como fallback",
             "/health - GET: Verificar estado de la API",
@@ -72,6 +134,7 @@ async def test_endpoints():
         "message": "Todos los endpoints están disponibles",
         "available_endpoints": [
             {"method": "POST", "path": "/send-email", "description": "Envía emails con opciones avanzadas"},
+            {"method": "POST", "path": "/send-bulk", "description": "Envía un lote de emails sobre una sola conexión"},
             {"method": "POST", "path": "/send-simple-email", "description": "Envía un email simple"},
             {"method": "POST", "path": "/send-email-with-attachment", "description": "Envía email con archivo adjunto"},
             {"method": "POST", "path": "/send_via_sendgrid_api", "description": "Envía email usando SendGrid API"},
@@ -86,15 +149,15 @@ async def send_email(email_request: EmailRequest):
     Envía un email con opciones avanzadas (CC, BCC, HTML)
     """
     try:
-        email_service = get_email_service()
-        
+        email_service = get_async_email_service()
+
         if not email_service.username or not email_service.password:
             raise HTTPException(
-                status_code=500, 
+                status_code=500,
                 detail="Configuración SMTP incompleta. Verifica las variables de entorno."
             )
-        
-        result = email_service.send_email(
+
+        result = await email_service.send_email(
             to_emails=email_request.to_emails,
             subject=email_request.subject,
             body=email_request.body,
@@ -117,15 +180,15 @@ async def send_via_sendgrid_api(email_request: SimpleEmailRequest):
     Envía un email con opciones avanzadas (CC, BCC, HTML) usando SendGrid API como fallback
     """
     try:
-        email_service = get_email_service()
+        email_service = get_async_email_service()
         print("SENDGRID_API_KEY: ", email_service.sendgrid_api_key)
-        if not email_service.sendgrid_api_key:  
+        if not email_service.sendgrid_api_key:
             raise HTTPException(
-                status_code=500, 
+                status_code=500,
                 detail="SENDGRID_API_KEY no configurado. Verifica las variables de entorno."
             )
-        
-        result = email_service.send_via_sendgrid_api(
+
+        result = await email_service.send_via_sendgrid_api(
             to_email=email_request.to_email,  
             subject=email_request.subject,    
             body=email_request.body,
@@ -140,21 +203,47 @@ async def send_via_sendgrid_api(email_request: SimpleEmailRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
+@app.post("/send-bulk")
+async def send_bulk(email_requests: List[BulkEmailItem]):
+    """
+    Envía un lote de emails reutilizando una sola conexión SMTP autenticada
+    """
+    try:
+        email_service = get_async_email_service()
+
+        if not email_service.username or not email_service.password:
+            raise HTTPException(
+                status_code=500,
+                detail="Configuración SMTP incompleta. Verifica las variables de entorno."
+            )
+
+        result = await email_service.send_bulk([request.model_dump() for request in email_requests])
+
+        if result["status"] == "error":
+            raise HTTPException(status_code=500, detail=result["message"])
+
+        return result
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+
 @app.post("/send-simple-email", response_model=EmailResponse)
 async def send_simple_email(email_request: SimpleEmailRequest):
     """
     Envía un email simple a un solo destinatario
     """
     try:
-        email_service = get_email_service()
-        
+        email_service = get_async_email_service()
+
         if not email_service.username or not email_service.password:
             raise HTTPException(
-                status_code=500, 
+                status_code=500,
                 detail="Configuración SMTP incompleta. Verifica las variables de entorno."
             )
-        
-        result = email_service.send_simple_email(
+
+        result = await email_service.send_simple_email(
             to_email=email_request.to_email,
             subject=email_request.subject,
             body=email_request.body
@@ -181,29 +270,30 @@ async def send_email_with_attachment(
     Envía un email con archivo adjunto
     """
     try:
-        email_service = get_email_service()
-        
+        email_service = get_async_email_service()
+
         if not email_service.username or not email_service.password:
             raise HTTPException(
-                status_code=500, 
+                status_code=500,
                 detail="Configuración SMTP incompleta. Verifica las variables de entorno."
             )
-        
+
         # Guardar archivo temporal
         temp_dir = tempfile.gettempdir()
         temp_filename = f"{uuid.uuid4()}_{file.filename}"
         temp_filepath = os.path.join(temp_dir, temp_filename)
         
+        # Copiar por chunks: el upload nunca se materializa entero en RAM
         with open(temp_filepath, "wb") as temp_file:
-            content = await file.read()
-            temp_file.write(content)
+            while chunk := await file.read(1 << 20):
+                temp_file.write(chunk)
         
         try:
             # Convertir strings a listas
             to_emails_list = [email.strip() for email in to_emails.split(",")]
             cc_emails_list = [email.strip() for email in cc_emails.split(",")] if cc_emails else None
             
-            result = email_service.send_email(
+            result = await email_service.send_email(
                 to_emails=to_emails_list,
                 subject=subject,
                 body=body,
@@ -227,11 +317,16 @@ async def send_email_with_attachment(
 
 if __name__ == "__main__":
     import uvicorn
-    
+
     host = os.getenv("API_HOST", "0.0.0.0")
     port = int(os.getenv("API_PORT", "8000"))
-    
+    workers = int(os.getenv("API_WORKERS", "1"))
+
     print(f"Iniciando servidor en http://{host}:{port}")
     print("Documentación disponible en: http://localhost:8000/docs")
-    
-    uvicorn.run(app, host=host, port=port)
\ No newline at end of file
+
+    # La app se pasa como string de import para poder levantar varios
+    # workers (procesos) y paralelizar de verdad el manejo de requests.
+    # loop/http en "auto" eligen uvloop/httptools si están instalados
+    # (uvicorn[standard]), con ~2x de throughput en el event loop.
+    uvicorn.run("main:app", host=host, port=port, workers=workers)
\ No newline at end of file